@@ -3,11 +3,31 @@ Celery 应用配置。
 
 该模块同时被 FastAPI Web 进程（提交任务）和 Celery Worker 进程（执行任务）引入。
 
+PDF 提取分为两个队列（见 tasks/extract.py）:
+    pdf_io_queue  — download_pdf_task，I/O 密集，threads pool，并发 = 4 × CPU 核数
+    pdf_cpu_queue — parse_pdf_task，CPU 密集，prefork pool，并发 = CPU 核数
+
 启动 Worker:
-    celery -A celery_app worker --loglevel=info --concurrency=4 -Q pdf_extract_queue
+    celery -A celery_app worker --loglevel=info -n io@%h \
+        -P threads -c $((4 * $(nproc))) -Q pdf_io_queue
+    celery -A celery_app worker --loglevel=info -n cpu@%h \
+        -P prefork -c $(nproc) -Q pdf_cpu_queue \
+        --max-tasks-per-child=50 --max-memory-per-child=1048576
+
+注意: threads pool 不执行 soft/hard 时间限制。下载总时长（PDF_EXTRACT_TASK_TIMEOUT）
+与文件大小（PDF_EXTRACT_MAX_FILE_SIZE）由 services/r2_storage.py 在读取数据块时检查。
+
+预取 (worker_prefetch_multiplier=2):
+    每个子进程额外预取一个任务，使 broker 取消息与当前任务执行重叠，
+    上一个 PDF 完成时下一个已在本地。代价是慢任务可能让已预取的消息
+    在该 worker 上排队（队头阻塞），因此对分钟级任务取 2 而不是 4。
+    配合 task_acks_late + task_reject_on_worker_lost，预取但未 ack 的
+    任务在 worker 崩溃时会重新入队，不会丢失。
 """
 
 from celery import Celery
+from kombu import Exchange, Queue
+
 from config import CELERY_BROKER_URL, CELERY_RESULT_BACKEND
 
 celery_app = Celery(
@@ -18,18 +38,44 @@ celery_app = Celery(
 )
 
 # 队列配置
+_pdf_exchange = Exchange('pdf_extract', type='direct', delivery_mode=1)
+
+# 非持久化队列 + transient 消息：任务在 Supabase 层幂等，可由 API 重新提交，
+# 无需 broker 为每条消息落盘（RabbitMQ 下省去 fsync；Redis broker 下不影响语义）。
 celery_app.conf.update(
+    task_queues=(
+        Queue(
+            'pdf_io_queue',
+            _pdf_exchange,
+            routing_key='pdf_io',
+            durable=False,
+        ),
+        Queue(
+            'pdf_cpu_queue',
+            _pdf_exchange,
+            routing_key='pdf_cpu',
+            durable=False,
+        ),
+    ),
     task_routes={
-        'tasks.extract_pdf': {
-            'queue': 'pdf_extract_queue',
+        'tasks.download_pdf': {
+            'queue': 'pdf_io_queue',
+        },
+        'tasks.parse_pdf': {
+            'queue': 'pdf_cpu_queue',
         },
     },
-    task_default_queue='pdf_extract_queue',
+    task_default_queue='pdf_cpu_queue',
     task_default_exchange='pdf_extract',
-    task_default_routing_key='pdf_extract',
+    task_default_routing_key='pdf_cpu',
+    task_default_delivery_mode='transient',
 
-    # Pool: solo 避免 daemon workers；PyMuPDF 解析是 CPU 密集型
-    worker_pool="solo",
+    # Pool: 默认 prefork，每个 CPU 核一个子进程；PyMuPDF 解析是 CPU 密集型且任务互相独立
+    # （I/O 队列的 Worker 在命令行以 -P threads 覆盖）
+    worker_pool="prefork",
+    # 定期回收子进程，释放 PyMuPDF (MuPDF context) 的内部缓存，防止 RSS 持续增长
+    worker_max_tasks_per_child=50,
+    worker_max_memory_per_child=1024 * 1024,  # KiB，即 1 GiB
 
     # 序列化
     task_serializer="json",
@@ -40,10 +86,12 @@ celery_app.conf.update(
     timezone="UTC",
     enable_utc=True,
 
+    # 结果: 状态统一记录在 Supabase，没有调用方读取 Celery 结果后端
+    task_ignore_result=True,
+
     # 可靠性
-    task_track_started=True,
     task_acks_late=True,
-    worker_prefetch_multiplier=1,
+    worker_prefetch_multiplier=2,
     task_reject_on_worker_lost=True,
 
     # 超时（秒）
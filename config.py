@@ -13,6 +13,7 @@ PaperViz PDF Service — 配置模块
 import os
 import sys
 from pathlib import Path
+from urllib.parse import urlparse, urlunparse
 from dotenv import load_dotenv
 
 # ── 确定当前环境 ────────────────────────────────────────
@@ -71,10 +72,25 @@ R2_ALLOWED_DOMAINS = os.getenv("R2_ALLOWED_DOMAINS", "")
 CELERY_BROKER_URL = os.getenv("CELERY_BROKER_URL", "redis://localhost:6379/0")
 CELERY_RESULT_BACKEND = os.getenv("CELERY_RESULT_BACKEND", "redis://localhost:6379/1")
 
+# ── 限流存储 (Redis) ─────────────────────────────────────
+# 多个 Web worker 共享同一计数器；默认复用 Celery Broker 的 Redis（同一主机与凭据），
+# 使用独立的 DB 索引 2
+_broker = urlparse(CELERY_BROKER_URL)
+_default_rate_limit_url = (
+    urlunparse(_broker._replace(path="/2"))
+    if _broker.scheme in ("redis", "rediss")
+    else "redis://localhost:6379/2"
+)
+RATE_LIMIT_STORAGE_URL = os.getenv("RATE_LIMIT_STORAGE_URL", _default_rate_limit_url)
+
 # ── PDF 提取限制 ─────────────────────────────────────────
 PDF_EXTRACT_MAX_FILE_SIZE = int(os.getenv("PDF_EXTRACT_MAX_FILE_SIZE", str(100 * 1024 * 1024)))
 PDF_EXTRACT_MAX_PAGES = int(os.getenv("PDF_EXTRACT_MAX_PAGES", "500"))
 PDF_EXTRACT_TASK_TIMEOUT = int(os.getenv("PDF_EXTRACT_TASK_TIMEOUT", "300"))
+# 下载任务与解析任务之间的 PDF 暂存目录（两类 Worker 必须共享）
+PDF_STAGING_DIR = os.getenv("PDF_STAGING_DIR", "/tmp/pdf_extract")
+# 暂存 PDF 的最长保留时间（秒），超过后由定期清理删除（硬超时 / 消息丢失时的兜底）
+PDF_STAGING_MAX_AGE = int(os.getenv("PDF_STAGING_MAX_AGE", "3600"))
 
 # ── 内部 API 鉴权 ────────────────────────────────────────
 # 用于微服务间安全通信的内部密钥，部署时必须在环境变量中设置
@@ -18,6 +18,11 @@ class ExtractionError(PDFServiceError):
     pass
 
 
+class DownloadTimeoutError(PDFServiceError):
+    """下载超过总时长上限（不可重试）。"""
+    pass
+
+
 class StorageError(PDFServiceError):
     """存储相关错误。"""
     pass
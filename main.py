@@ -10,35 +10,44 @@ FastAPI Web 层接收提取请求、校验参数、分发 Celery 异步任务，
 实际 PDF 文本提取由 PyMuPDF (fitz) 在 Celery Worker 进程内执行。
 
 启动:
-    uvicorn main:app --host 0.0.0.0 --port 8000
+    uvicorn main:app --host 0.0.0.0 --port 8000 \
+        --loop uvloop --http httptools --workers 4
 """
 
+import asyncio
+import hmac
 import logging
 import os
-from functools import wraps
+import time
+import uuid
+from contextlib import asynccontextmanager
 
 import uvicorn
-from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi import Depends, FastAPI, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
+from pydantic import BaseModel
 from slowapi import Limiter
 from slowapi.errors import RateLimitExceeded
 from slowapi.util import get_remote_address
 
 from celery_app import celery_app
-from config import INTERNAL_API_KEY
+from config import INTERNAL_API_KEY, RATE_LIMIT_STORAGE_URL
 from schemas.extract import (
     CancelResponse,
     ExtractRequest,
     ExtractResponse,
     ExtractStatusResponse,
+    UUIDStr,
 )
 from services.supabase_client import (
-    get_extract,
-    mark_cancelled,
-    upsert_extract,
+    aget_extract,
+    amark_cancelled,
+    aupsert_extract,
+    close_async_client,
+    init_async_client,
 )
-from tasks.extract import extract_pdf_task
+from tasks.extract import extract_pdf_pipeline
 
 # ── 日志 ───────────────────────────────────────────────
 logging.basicConfig(
@@ -48,30 +57,48 @@ logging.basicConfig(
 logger = logging.getLogger("pdf_service.main")
 
 # ── 限流 ──────────────────────────────────────────────
-limiter = Limiter(key_func=get_remote_address)
+# 计数存放在 Redis，多个 uvicorn worker 共享同一限额；
+# Redis 不可用时退回进程内计数，避免限流存储故障导致提交接口 500
+limiter = Limiter(
+    key_func=get_remote_address,
+    storage_uri=RATE_LIMIT_STORAGE_URL,
+    strategy="fixed-window",
+    in_memory_fallback_enabled=True,
+)
 
 # ── 内部 API 鉴权 ─────────────────────────────────────
+# 导入时预先编码，供 hmac.compare_digest 做常量时间比较
+_EXPECTED_TOKEN = INTERNAL_API_KEY.encode() if INTERNAL_API_KEY else None
+
+
 def verify_internal_token(request: Request) -> bool:
     """
     验证内部 API 密钥。
     
-    检查请求头 X-Internal-Token 是否与服务端配置的 INTERNAL_API_KEY 匹配。
+    检查请求头 X-Internal-Token 是否与服务端配置的 INTERNAL_API_KEY 匹配
+    （常量时间比较）。结果缓存在 ``request.state`` 上，同一请求只校验一次。
     如果未配置 INTERNAL_API_KEY，则跳过验证（仅用于开发环境）。
     """
-    if not INTERNAL_API_KEY:
+    cached = getattr(request.state, "internal_auth_ok", None)
+    if cached is not None:
+        return cached
+
+    if _EXPECTED_TOKEN is None:
         # 未配置密钥，跳过验证（仅开发环境使用）
         logger.warning("INTERNAL_API_KEY 未配置，已跳过鉴权验证")
-        return True
-    
-    auth_header = request.headers.get("X-Internal-Token")
-    if not auth_header:
-        return False
-    
-    return auth_header == INTERNAL_API_KEY
+        ok = True
+    else:
+        auth_header = request.headers.get("X-Internal-Token")
+        ok = auth_header is not None and hmac.compare_digest(
+            auth_header.encode(), _EXPECTED_TOKEN
+        )
+
+    request.state.internal_auth_ok = ok
+    return ok
 
 
-async def require_internal_auth(request: Request, response: Response):
-    """内部 API 认证依赖项，用于 FastAPI 路由保护。"""
+async def require_internal_auth(request: Request) -> None:
+    """内部 API 认证依赖项，通过 ``Depends`` 用于 FastAPI 路由保护。"""
     if not verify_internal_token(request):
         logger.warning(f"内部 API 鉴权失败: 缺少或无效的 X-Internal-Token 头")
         raise HTTPException(
@@ -80,10 +107,21 @@ async def require_internal_auth(request: Request, response: Response):
         )
 
 # ── FastAPI 应用 ─────────────────────────────────────
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """进程级资源：共享的 Supabase 异步 HTTP 连接池。"""
+    await init_async_client()
+    try:
+        yield
+    finally:
+        await close_async_client()
+
+
 app = FastAPI(
     title="PaperViz PDF Service",
     version="1.0.0",
     description="独立 PDF 提取微服务 — PyMuPDF 文本提取（AGPL-3.0 隔离）",
+    lifespan=lifespan,
 )
 app.state.limiter = limiter
 
@@ -105,58 +143,113 @@ app.add_middleware(
 
 
 # ── 健康检查 ──────────────────────────────────────────
+# Celery ping 是阻塞的 broker RPC（最长 timeout 秒），结果缓存 _HEALTH_CACHE_TTL 秒，
+# 并在线程池中执行，避免健康检查风暴占满事件循环。
 
-@app.get("/health")
-async def health():
-    """服务健康状态 + 依赖检查。"""
-    # 检查 PyMuPDF 是否可导入
-    pymupdf_ok = False
-    pymupdf_version = "unknown"
-    try:
-        import fitz
-        pymupdf_version = fitz.__doc__.strip() if fitz.__doc__ else "unknown"
-        pymupdf_ok = True
-    except ImportError:
-        pass
-
-    # 检查 Celery Worker 状态
-    celery_ok = False
+_HEALTH_CACHE_TTL = 5.0
+
+# PyMuPDF 版本在进程生命周期内不变，导入时计算一次
+try:
+    import fitz
+    _PYMUPDF_VERSION = (fitz.__doc__ or "unknown").strip()
+    _PYMUPDF_OK = True
+except ImportError:
+    _PYMUPDF_VERSION = "unknown"
+    _PYMUPDF_OK = False
+
+_health_cache = {"ts": 0.0, "val": None}
+_health_lock = asyncio.Lock()
+
+
+def _ping_celery_workers() -> bool:
+    """同步 ping Celery Worker（在线程池中调用）。"""
     try:
-        inspector = celery_app.control.inspect(timeout=3)
+        inspector = celery_app.control.inspect(timeout=1)
         workers = inspector.ping()
-        celery_ok = bool(workers)
+        return bool(workers)
     except Exception:
-        pass
+        return False
+
+
+def _cached_celery_status():
+    """返回未过期的缓存 ping 结果；无缓存或已过期时返回 None。"""
+    if (
+        _health_cache["val"] is not None
+        and time.monotonic() - _health_cache["ts"] < _HEALTH_CACHE_TTL
+    ):
+        return _health_cache["val"]
+    return None
+
+
+async def _celery_healthy() -> bool:
+    """带 TTL 缓存的 Celery Worker 健康状态。"""
+    cached = _cached_celery_status()
+    if cached is not None:
+        return cached
+
+    async with _health_lock:
+        # 等锁期间可能已有其他请求刷新了缓存
+        cached = _cached_celery_status()
+        if cached is not None:
+            return cached
+        celery_ok = await asyncio.to_thread(_ping_celery_workers)
+        _health_cache["ts"] = time.monotonic()
+        _health_cache["val"] = celery_ok
+        return celery_ok
 
-    overall = "ok" if (pymupdf_ok and celery_ok) else "degraded"
+
+def _health_payload(status_ok: bool, celery_healthy) -> dict:
     return {
-        "status": overall,
+        "status": "ok" if status_ok else "degraded",
         "service": "paperviz-pdf",
         "version": "1.0.0",
         "pymupdf": {
-            "version": pymupdf_version,
-            "available": pymupdf_ok,
+            "version": _PYMUPDF_VERSION,
+            "available": _PYMUPDF_OK,
             "mode": "in-process (Python API)",
         },
-        "celery": {"healthy": celery_ok},
+        "celery": {"healthy": celery_healthy},
     }
 
 
+@app.get("/health")
+async def health():
+    """
+    快速健康检查（用于存活探针）。
+
+    不触发 Celery ping，``status`` 只反映本进程（PyMuPDF）状态。
+    ``celery.healthy`` 为本进程 _HEALTH_CACHE_TTL 秒内的缓存结果，
+    无缓存或已过期时为 ``"unknown"``；Worker 状态请查询 ``/health/deep``。
+    """
+    cached = _cached_celery_status()
+    return _health_payload(
+        _PYMUPDF_OK, "unknown" if cached is None else cached
+    )
+
+
+@app.get("/health/deep")
+async def health_deep():
+    """服务健康状态 + 依赖检查（Celery ping 结果缓存 5 秒）。"""
+    celery_ok = await _celery_healthy()
+    return _health_payload(_PYMUPDF_OK and celery_ok, celery_ok)
+
+
 # ── POST /extract ───────────────────────────────────
 
-@app.post("/extract", response_model=ExtractResponse)
+@app.post(
+    "/extract",
+    response_model=ExtractResponse,
+    dependencies=[Depends(require_internal_auth)],
+)
 @limiter.limit("10/minute")
 async def start_extraction(req: ExtractRequest, request: Request, response: Response):
     """提交新提取任务（或返回已有进度）。"""
-    # 内部 API 鉴权
-    await require_internal_auth(request, response)
-    
     logger.info(
         f"POST /extract — paper_id={req.paper_id}, mode={req.mode}"
     )
 
     # 检查是否有已有提取记录
-    existing = get_extract(req.paper_id)
+    existing = await aget_extract(req.paper_id)
     if existing:
         # 检查模式是否一致
         existing_mode = existing.get("extract_mode")
@@ -177,24 +270,23 @@ async def start_extraction(req: ExtractRequest, request: Request, response: Resp
                     message=f"提取进行中 (状态: {status})",
                 )
 
-    # 创建初始数据库记录
-    upsert_extract(req.paper_id, {
+    # 预先生成任务 ID，使初始记录与 celery_task_id 一次写入；
+    # 记录先于任务分发写入，Worker 的 downloading 状态不会被覆盖
+    task_id = str(uuid.uuid4())
+    await aupsert_extract(req.paper_id, {
         "status": "queued",
         "extract_mode": req.mode,
         "error_message": None,
         "progress_percent": 0,
+        "celery_task_id": task_id,
     })
 
     # 分发 Celery 任务
-    task = extract_pdf_task.apply_async(
-        kwargs={
-            "paper_id": req.paper_id,
-            "file_url": req.file_url,
-            "mode": req.mode,
-        },
-    )
-
-    upsert_extract(req.paper_id, {"celery_task_id": task.id})
+    task = extract_pdf_pipeline(
+        paper_id=req.paper_id,
+        file_url=req.file_url,
+        mode=req.mode,
+    ).apply_async(task_id=task_id)
 
     logger.info(f"[{req.paper_id}] Celery task dispatched → {task.id}")
     return ExtractResponse(
@@ -207,22 +299,30 @@ async def start_extraction(req: ExtractRequest, request: Request, response: Resp
 
 # ── GET /extract/status/{paper_id} ─────────────────
 
+def _json_response(model: BaseModel) -> Response:
+    """由 pydantic-core 直接序列化为 JSON 响应。"""
+    return Response(content=model.model_dump_json(), media_type="application/json")
+
+
 @app.get(
     "/extract/status/{paper_id}",
     response_model=ExtractStatusResponse,
+    dependencies=[Depends(require_internal_auth)],
 )
-async def get_extract_status(paper_id: str, request: Request, response: Response):
-    """查询当前提取状态和进度。"""
-    # 内部 API 鉴权
-    await require_internal_auth(request, response)
-    
-    record = get_extract(paper_id)
+async def get_extract_status(paper_id: UUIDStr) -> Response:
+    """
+    查询当前提取状态和进度。
+
+    轮询最频繁的接口：直接返回 ``model_dump_json()`` 的结果，
+    跳过 FastAPI 的 response_model 校验与 jsonable_encoder。
+    """
+    record = await aget_extract(paper_id)
     if not record:
-        return ExtractStatusResponse(
+        return _json_response(ExtractStatusResponse(
             paper_id=paper_id, status="not_found"
-        )
+        ))
 
-    return ExtractStatusResponse(
+    return _json_response(ExtractStatusResponse(
         paper_id=paper_id,
         status=record.get("status", "unknown"),
         progress_percent=record.get("progress_percent", 0),
@@ -232,21 +332,41 @@ async def get_extract_status(paper_id: str, request: Request, response: Response
         celery_task_id=record.get("celery_task_id"),
         started_at=record.get("started_at"),
         completed_at=record.get("completed_at"),
-    )
+    ))
 
 
 # ── POST /extract/cancel/{paper_id} ────────────────
 
+# 持有后台任务的强引用，防止未完成时被垃圾回收
+_background_tasks: set[asyncio.Task] = set()
+
+
+def _spawn_background(coro) -> None:
+    """以 fire-and-forget 方式调度协程。"""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+
+def _revoke_celery_task(paper_id: str, celery_task_id: str) -> None:
+    """同步广播 revoke 控制命令（在线程池中调用）。"""
+    try:
+        celery_app.control.revoke(celery_task_id, terminate=True)
+        logger.info(f"[{paper_id}] Celery task {celery_task_id} revoked")
+    except Exception as e:
+        logger.warning(
+            f"[{paper_id}] Failed to revoke Celery task {celery_task_id}: {e}"
+        )
+
+
 @app.post(
     "/extract/cancel/{paper_id}",
     response_model=CancelResponse,
+    dependencies=[Depends(require_internal_auth)],
 )
-async def cancel_extraction(paper_id: str, request: Request, response: Response):
+async def cancel_extraction(paper_id: UUIDStr):
     """取消进行中的提取任务。"""
-    # 内部 API 鉴权
-    await require_internal_auth(request, response)
-    
-    record = get_extract(paper_id)
+    record = await aget_extract(paper_id)
     if not record:
         raise HTTPException(status_code=404, detail="提取记录不存在")
 
@@ -257,13 +377,14 @@ async def cancel_extraction(paper_id: str, request: Request, response: Response)
             message=f"无法取消: 当前状态为 {status}",
         )
 
-    # 撤销 Celery 任务
+    # 撤销 Celery 任务（后台线程广播，不等待）
     celery_task_id = record.get("celery_task_id")
     if celery_task_id:
-        celery_app.control.revoke(celery_task_id, terminate=True)
-        logger.info(f"[{paper_id}] Celery task {celery_task_id} revoked")
+        _spawn_background(
+            asyncio.to_thread(_revoke_celery_task, paper_id, celery_task_id)
+        )
 
-    mark_cancelled(paper_id)
+    await amark_cancelled(paper_id)
     return CancelResponse(success=True, message="提取任务已取消")
 
 
@@ -272,4 +393,15 @@ async def cancel_extraction(paper_id: str, request: Request, response: Response)
 if __name__ == "__main__":
     port = int(os.getenv("PORT", "8000"))
     logger.info(f"PDF Service v1.0 starting on :{port}")
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    # uvloop + httptools: C 实现的事件循环与 HTTP 解析器（由 uvicorn[standard] 提供）
+    # 多 worker 需要以 import 字符串传入 app
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=port,
+        loop="uvloop",
+        http="httptools",
+        workers=int(os.getenv("WEB_WORKERS", "4")),
+        limit_concurrency=1000,
+        timeout_keep_alive=30,
+    )
@@ -3,6 +3,7 @@ from .extract import (
     ExtractResponse,
     ExtractStatusResponse,
     CancelResponse,
+    UUIDStr,
 )
 
 __all__ = [
@@ -10,4 +11,5 @@ __all__ = [
     "ExtractResponse",
     "ExtractStatusResponse",
     "CancelResponse",
+    "UUIDStr",
 ]
@@ -2,30 +2,30 @@
 PDF 提取 API 的 Pydantic 模型。
 """
 
-import uuid
-from typing import Literal, Optional
+from typing import Annotated, Literal, Optional
+from uuid import UUID
 
-from pydantic import BaseModel, field_validator
+from pydantic import AfterValidator, BaseModel, ConfigDict
+
+# 由 pydantic-core 校验 UUID，校验后转回规范化（小写、带连字符）字符串供下游
+# （Supabase / Celery JSON）使用。所有接收 paper_id 的接口（请求体与路径参数）
+# 都必须使用该类型，保证同一论文在各接口中的 ID 一致。
+UUIDStr = Annotated[UUID, AfterValidator(str)]
 
 
 class ExtractRequest(BaseModel):
     """POST /extract 的请求体"""
-    paper_id: str
+    model_config = ConfigDict(frozen=True)
+
+    paper_id: UUIDStr
     file_url: str
     mode: Literal["text", "markdown"] = "text"
 
-    @field_validator("paper_id")
-    @classmethod
-    def validate_paper_id(cls, v: str) -> str:
-        try:
-            uuid.UUID(v)
-        except ValueError:
-            raise ValueError("paper_id must be a valid UUID")
-        return v
-
 
 class ExtractResponse(BaseModel):
     """POST /extract 的响应"""
+    model_config = ConfigDict(frozen=True, extra="forbid")
+
     success: bool
     celery_task_id: Optional[str] = None
     paper_id: str
@@ -34,6 +34,8 @@ class ExtractResponse(BaseModel):
 
 class ExtractStatusResponse(BaseModel):
     """GET /extract/status/{paper_id} 的响应"""
+    model_config = ConfigDict(frozen=True, extra="forbid")
+
     paper_id: str
     status: str
     progress_percent: int = 0
@@ -47,5 +49,7 @@ class ExtractStatusResponse(BaseModel):
 
 class CancelResponse(BaseModel):
     """POST /extract/cancel/{paper_id} 的响应"""
+    model_config = ConfigDict(frozen=True, extra="forbid")
+
     success: bool
     message: str
@@ -7,6 +7,10 @@ Cloudflare R2 (S3 兼容) 存储助手。
 import ipaddress
 import logging
 import re
+import tempfile
+import time
+from pathlib import Path
+from typing import BinaryIO, Iterable, Optional
 from urllib.parse import urlparse
 
 import boto3
@@ -19,8 +23,10 @@ from config import (
     R2_BUCKET_NAME,
     R2_PUBLIC_URL,
     R2_ALLOWED_DOMAINS,
+    PDF_EXTRACT_MAX_FILE_SIZE,
+    PDF_EXTRACT_TASK_TIMEOUT,
 )
-from exceptions import StorageError
+from exceptions import DownloadTimeoutError, FileValidationError, StorageError
 
 logger = logging.getLogger("pdf_service.r2_storage")
 
@@ -99,19 +105,56 @@ def _get_s3_client():
     )
 
 
-def download_pdf(file_url: str) -> bytes:
+_DOWNLOAD_CHUNK_SIZE = 1 << 20  # 1 MiB
+
+# 不再尝试其他下载来源、直接抛给任务的错误
+_FATAL_DOWNLOAD_ERRORS = (FileValidationError, DownloadTimeoutError)
+
+
+def _copy_chunks(chunks: Iterable[bytes], dest: BinaryIO, deadline: float) -> None:
     """
-    从 R2（或任意公网 URL）下载 PDF。
+    将数据块写入 ``dest``，同时检查总时长与文件大小上限。
 
-    解析顺序:
-    1. 直接 HTTP URL（如果 file_url 以 http 开头）
-    2. R2 公网 URL + 相对 key
-    3. R2 S3 API + 相对 key
-    
-    安全检查:
-    - HTTP URL 必须通过 SSRF 防护验证
-    - 只允许访问白名单域名
-    - 禁止访问内网 IP
+    HTTP/S3 客户端的超时只针对单次连接/读取，慢速发送的服务端可以无限拖长下载；
+    因此在每个数据块之后检查 ``deadline``（``time.monotonic()``）。
+    超过 PDF_EXTRACT_MAX_FILE_SIZE 立即停止，避免把超大文件完整写入暂存目录。
+    """
+    max_mb = PDF_EXTRACT_MAX_FILE_SIZE / (1024 * 1024)
+    written = 0
+    for chunk in chunks:
+        written += len(chunk)
+        if written > PDF_EXTRACT_MAX_FILE_SIZE:
+            raise FileValidationError(f"文件过大: 超过上限 {max_mb:.0f}MB")
+        dest.write(chunk)
+        if time.monotonic() > deadline:
+            raise DownloadTimeoutError(
+                f"下载超时 (超过 {PDF_EXTRACT_TASK_TIMEOUT} 秒)"
+            )
+
+
+def _stream_url_to_file(url: str, dest: BinaryIO, deadline: float) -> int:
+    """
+    以流式方式将 HTTP 响应体写入 ``dest``（写入前清空）。
+
+    返回写入的字节数；非 200 响应返回 0。
+    """
+    dest.seek(0)
+    dest.truncate()
+    with httpx.stream("GET", url, timeout=60.0, follow_redirects=True) as resp:
+        if resp.status_code != 200:
+            return 0
+        _copy_chunks(
+            resp.iter_bytes(chunk_size=_DOWNLOAD_CHUNK_SIZE), dest, deadline
+        )
+    dest.flush()
+    return dest.tell()
+
+
+def _download_pdf_into(file_url: str, dest: BinaryIO, deadline: float) -> bool:
+    """
+    按解析顺序尝试下载到 ``dest``，成功返回 True。
+
+    超时与超限错误直接抛出，不再尝试下一个来源。
     """
     # ── 1. 直接 URL ─────────────────────────────────
     if file_url.startswith("http"):
@@ -121,10 +164,12 @@ def download_pdf(file_url: str) -> bytes:
             raise StorageError(f"URL 安全验证失败: {file_url}")
         
         try:
-            resp = httpx.get(file_url, timeout=60.0, follow_redirects=True)
-            if resp.status_code == 200 and len(resp.content) > 0:
-                logger.info(f"Downloaded PDF via URL: {len(resp.content)} bytes")
-                return resp.content
+            size = _stream_url_to_file(file_url, dest, deadline)
+            if size > 0:
+                logger.info(f"Downloaded PDF via URL: {size} bytes")
+                return True
+        except _FATAL_DOWNLOAD_ERRORS:
+            raise
         except Exception as e:
             logger.warning(f"Direct URL download failed: {e}")
 
@@ -133,45 +178,93 @@ def download_pdf(file_url: str) -> bytes:
     if R2_PUBLIC_URL and r2_key:
         public_url = f"{R2_PUBLIC_URL.rstrip('/')}/{r2_key}"
         try:
-            resp = httpx.get(public_url, timeout=60.0, follow_redirects=True)
-            if resp.status_code == 200 and len(resp.content) > 0:
-                logger.info(
-                    f"Downloaded PDF via R2 public URL: {len(resp.content)} bytes"
-                )
-                return resp.content
+            size = _stream_url_to_file(public_url, dest, deadline)
+            if size > 0:
+                logger.info(f"Downloaded PDF via R2 public URL: {size} bytes")
+                return True
+        except _FATAL_DOWNLOAD_ERRORS:
+            raise
         except Exception as e:
             logger.warning(f"R2 public URL download failed: {e}")
 
     # ── 3. R2 S3 API ─────────────────────────────
     if R2_ACCESS_KEY_ID and r2_key:
         try:
+            dest.seek(0)
+            dest.truncate()
             s3 = _get_s3_client()
             obj = s3.get_object(Bucket=R2_BUCKET_NAME, Key=r2_key)
-            data = obj["Body"].read()
-            logger.info(f"Downloaded PDF via R2 S3 API: {len(data)} bytes")
-            return data
+            _copy_chunks(
+                obj["Body"].iter_chunks(chunk_size=_DOWNLOAD_CHUNK_SIZE),
+                dest,
+                deadline,
+            )
+            dest.flush()
+            logger.info(f"Downloaded PDF via R2 S3 API: {dest.tell()} bytes")
+            return True
+        except _FATAL_DOWNLOAD_ERRORS:
+            raise
         except Exception as e:
             logger.warning(f"R2 S3 API download failed: {e}")
 
+    return False
+
+
+def download_pdf_to_file(file_url: str, dir: Optional[str] = None) -> Path:
+    """
+    从 R2（或任意公网 URL）流式下载 PDF 到临时文件。
+
+    解析顺序:
+    1. 直接 HTTP URL（如果 file_url 以 http 开头）
+    2. R2 公网 URL + 相对 key
+    3. R2 S3 API + 相对 key
+    
+    安全检查:
+    - HTTP URL 必须通过 SSRF 防护验证
+    - 只允许访问白名单域名
+    - 禁止访问内网 IP
+
+    限制（所有来源合计）:
+    - 总时长不超过 PDF_EXTRACT_TASK_TIMEOUT 秒，否则抛出 DownloadTimeoutError
+    - 大小不超过 PDF_EXTRACT_MAX_FILE_SIZE，否则抛出 FileValidationError
+
+    ``dir`` 指定临时文件所在目录（默认系统临时目录）。
+    返回临时文件路径，由调用方负责删除。
+    """
+    deadline = time.monotonic() + PDF_EXTRACT_TASK_TIMEOUT
+    tmp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".pdf", dir=dir)
+    path = Path(tmp_file.name)
+    try:
+        with tmp_file:
+            if _download_pdf_into(file_url, tmp_file, deadline):
+                return path
+    except BaseException:
+        path.unlink(missing_ok=True)
+        raise
+
+    path.unlink(missing_ok=True)
     raise StorageError(f"Cannot download PDF from: {file_url}")
 
 
-def upload_text(text: str, key: str) -> str:
+def upload_text_stream(fileobj: BinaryIO, key: str) -> str:
     """
-    上传提取的文本到 R2。
+    以流式方式上传 UTF-8 编码的文本文件对象到 R2。
+
+    使用 boto3 ``upload_fileobj``（大文件自动分片上传），无需把整篇文本读入内存。
+    调用方负责在调用前将 ``fileobj`` 定位到起始位置。
 
     返回已上传文件的公网 URL。
     """
     try:
         s3 = _get_s3_client()
-        s3.put_object(
-            Bucket=R2_BUCKET_NAME,
-            Key=key,
-            Body=text.encode("utf-8"),
-            ContentType="text/plain; charset=utf-8",
+        s3.upload_fileobj(
+            fileobj,
+            R2_BUCKET_NAME,
+            key,
+            ExtraArgs={"ContentType": "text/plain; charset=utf-8"},
         )
         url = f"{R2_PUBLIC_URL.rstrip('/')}/{key}" if R2_PUBLIC_URL else key
-        logger.info(f"Uploaded text to R2: {key} ({len(text)} chars)")
+        logger.info(f"Uploaded text to R2: {key} ({fileobj.tell()} bytes)")
         return url
     except Exception as e:
         raise StorageError(f"Failed to upload text to R2: {e}")
@@ -1,13 +1,17 @@
 """
 Supabase REST API 客户端 — 管理 PDF 提取记录。
 
-使用 Supabase 提供的 PostgREST API — 所有调用为同步
-（适用于 Celery Worker 上下文）。
+使用 Supabase 提供的 PostgREST API。
+
+- 同步函数（``get_extract`` / ``upsert_extract`` / ...）用于 Celery Worker 上下文；
+- ``a`` 前缀的异步函数（``aget_extract`` / ``aupsert_extract`` / ...）用于
+  FastAPI 事件循环，共享一个在 ``lifespan`` 中初始化的 ``httpx.AsyncClient``。
 
 本服务将 PDF 提取状态记录到 ``pdf_extract_tasks`` 表。
 """
 
 import logging
+import threading
 from datetime import datetime, timezone
 from typing import Optional
 
@@ -50,61 +54,123 @@ def _headers() -> dict:
     }
 
 
+# ── 连接池 ─────────────────────────────────────────────
+# 复用 TCP/TLS 连接，避免每次调用重新握手。
+# 同步客户端按进程惰性创建（加锁，threads pool 下多个线程共享同一个客户端）；
+# prefork 子进程通过 reset_client() 重建，不共享父进程的连接。
+
+_POOL_LIMITS = httpx.Limits(max_connections=50, max_keepalive_connections=20)
+
+_client: Optional[httpx.Client] = None
+_client_lock = threading.Lock()
+_client_limits = _POOL_LIMITS
+
+
+def configure_pool(concurrency: int) -> None:
+    """
+    按 Worker 并发数设置同步客户端的连接上限。
+
+    threads pool 下所有线程共享一个客户端，连接上限不能低于线程数，
+    否则 Supabase 调用会排队直到连接池超时。须在客户端创建前调用。
+    """
+    global _client_limits
+    size = max(_POOL_LIMITS.max_connections, concurrency)
+    _client_limits = httpx.Limits(
+        max_connections=size,
+        max_keepalive_connections=max(_POOL_LIMITS.max_keepalive_connections, concurrency),
+    )
+
+
+def _get_client() -> httpx.Client:
+    """返回进程内共享的 ``httpx.Client``（惰性创建，线程安全）。"""
+    global _client
+    client = _client
+    if client is None:
+        with _client_lock:
+            if _client is None:
+                _client = httpx.Client(timeout=15.0, limits=_client_limits)
+            client = _client
+    return client
+
+
+def reset_client() -> None:
+    """
+    丢弃当前进程的同步客户端，下次调用时重新创建。
+
+    在 Celery ``worker_process_init`` 中调用，使每个 prefork 子进程拥有独立连接池。
+    继承自父进程的客户端只丢弃引用而不 ``close()``，以免关闭父进程仍在使用的连接；
+    锁同样重建，避免继承 fork 时处于持有状态的锁。
+    """
+    global _client, _client_lock
+    _client = None
+    _client_lock = threading.Lock()
+
+
+def _prepare_upsert(paper_id: str, data: dict) -> dict:
+    """填充 ``paper_id`` / ``updated_at`` 并映射状态值。"""
+    data["paper_id"] = paper_id
+    data["updated_at"] = datetime.now(timezone.utc).isoformat()
+    return _map_status(data)
+
+
+def _apply_insert_defaults(data: dict) -> None:
+    """新建记录时的默认字段。"""
+    data.setdefault("status", "pending")
+    data.setdefault("progress_percent", 0)
+    data.setdefault("page_count", 0)
+    data.setdefault("text_length", 0)
+
+
 def upsert_extract(paper_id: str, data: dict) -> None:
     """
     创建或更新 ``pdf_extract_tasks`` 表中的记录。
 
     每次调用自动设置 ``paper_id`` 和 ``updated_at``。
     """
-    data["paper_id"] = paper_id
-    data["updated_at"] = datetime.now(timezone.utc).isoformat()
-    data = _map_status(data)
+    data = _prepare_upsert(paper_id, data)
+
+    client = _get_client()
 
-    with httpx.Client(timeout=15.0) as client:
-        resp = client.get(
+    resp = client.get(
+        f"{SUPABASE_URL}/rest/v1/pdf_extract_tasks"
+        f"?paper_id=eq.{paper_id}&select=id",
+        headers=_headers(),
+    )
+    exists = resp.status_code == 200 and resp.json()
+
+    if exists:
+        resp = client.patch(
             f"{SUPABASE_URL}/rest/v1/pdf_extract_tasks"
-            f"?paper_id=eq.{paper_id}&select=id",
+            f"?paper_id=eq.{paper_id}",
             headers=_headers(),
+            json=data,
+        )
+    else:
+        _apply_insert_defaults(data)
+        resp = client.post(
+            f"{SUPABASE_URL}/rest/v1/pdf_extract_tasks",
+            headers=_headers(),
+            json=data,
+        )
+
+    if resp.status_code not in (200, 201, 204):
+        logger.error(
+            f"[{paper_id}] Supabase upsert failed: "
+            f"{resp.status_code} {resp.text[:300]}"
         )
-        exists = resp.status_code == 200 and resp.json()
-
-        if exists:
-            resp = client.patch(
-                f"{SUPABASE_URL}/rest/v1/pdf_extract_tasks"
-                f"?paper_id=eq.{paper_id}",
-                headers=_headers(),
-                json=data,
-            )
-        else:
-            data.setdefault("status", "pending")
-            data.setdefault("progress_percent", 0)
-            data.setdefault("page_count", 0)
-            data.setdefault("text_length", 0)
-            resp = client.post(
-                f"{SUPABASE_URL}/rest/v1/pdf_extract_tasks",
-                headers=_headers(),
-                json=data,
-            )
-
-        if resp.status_code not in (200, 201, 204):
-            logger.error(
-                f"[{paper_id}] Supabase upsert failed: "
-                f"{resp.status_code} {resp.text[:300]}"
-            )
 
 
 def get_extract(paper_id: str) -> Optional[dict]:
     """获取指定论文的提取记录。"""
-    with httpx.Client(timeout=15.0) as client:
-        resp = client.get(
-            f"{SUPABASE_URL}/rest/v1/pdf_extract_tasks"
-            f"?paper_id=eq.{paper_id}&select=*",
-            headers=_headers(),
-        )
-        if resp.status_code != 200:
-            return None
-        rows = resp.json()
-        return rows[0] if rows else None
+    resp = _get_client().get(
+        f"{SUPABASE_URL}/rest/v1/pdf_extract_tasks"
+        f"?paper_id=eq.{paper_id}&select=*",
+        headers=_headers(),
+    )
+    if resp.status_code != 200:
+        return None
+    rows = resp.json()
+    return rows[0] if rows else None
 
 
 def mark_failed(paper_id: str, error_message: str) -> None:
@@ -121,3 +187,86 @@ def mark_cancelled(paper_id: str) -> None:
         "status": "cancelled",
         "error_message": None,
     })
+
+
+# ── 异步接口（FastAPI） ─────────────────────────────────
+
+_async_client: Optional[httpx.AsyncClient] = None
+
+
+async def init_async_client() -> None:
+    """创建共享的 ``httpx.AsyncClient``（在 FastAPI ``lifespan`` 启动时调用）。"""
+    global _async_client
+    if _async_client is None:
+        _async_client = httpx.AsyncClient(timeout=15.0, limits=_POOL_LIMITS)
+
+
+async def close_async_client() -> None:
+    """关闭共享的 ``httpx.AsyncClient``（在 FastAPI ``lifespan`` 退出时调用）。"""
+    global _async_client
+    if _async_client is not None:
+        await _async_client.aclose()
+        _async_client = None
+
+
+def _get_async_client() -> httpx.AsyncClient:
+    """返回共享异步客户端；未经 ``lifespan`` 初始化时惰性创建。"""
+    global _async_client
+    if _async_client is None:
+        _async_client = httpx.AsyncClient(timeout=15.0, limits=_POOL_LIMITS)
+    return _async_client
+
+
+async def aupsert_extract(paper_id: str, data: dict) -> None:
+    """``upsert_extract`` 的异步版本。"""
+    data = _prepare_upsert(paper_id, data)
+    client = _get_async_client()
+
+    resp = await client.get(
+        f"{SUPABASE_URL}/rest/v1/pdf_extract_tasks"
+        f"?paper_id=eq.{paper_id}&select=id",
+        headers=_headers(),
+    )
+    exists = resp.status_code == 200 and resp.json()
+
+    if exists:
+        resp = await client.patch(
+            f"{SUPABASE_URL}/rest/v1/pdf_extract_tasks"
+            f"?paper_id=eq.{paper_id}",
+            headers=_headers(),
+            json=data,
+        )
+    else:
+        _apply_insert_defaults(data)
+        resp = await client.post(
+            f"{SUPABASE_URL}/rest/v1/pdf_extract_tasks",
+            headers=_headers(),
+            json=data,
+        )
+
+    if resp.status_code not in (200, 201, 204):
+        logger.error(
+            f"[{paper_id}] Supabase upsert failed: "
+            f"{resp.status_code} {resp.text[:300]}"
+        )
+
+
+async def aget_extract(paper_id: str) -> Optional[dict]:
+    """``get_extract`` 的异步版本。"""
+    resp = await _get_async_client().get(
+        f"{SUPABASE_URL}/rest/v1/pdf_extract_tasks"
+        f"?paper_id=eq.{paper_id}&select=*",
+        headers=_headers(),
+    )
+    if resp.status_code != 200:
+        return None
+    rows = resp.json()
+    return rows[0] if rows else None
+
+
+async def amark_cancelled(paper_id: str) -> None:
+    """``mark_cancelled`` 的异步版本。"""
+    await aupsert_extract(paper_id, {
+        "status": "cancelled",
+        "error_message": None,
+    })
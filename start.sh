@@ -9,13 +9,31 @@ set -e
 echo "[PDF Service] Starting FastAPI and Celery Worker..."
 
 # 启动 Celery Worker（后台运行）
+# I/O 队列：下载 PDF，threads pool 高并发
 celery -A celery_app worker \
     --loglevel=info \
-    --concurrency=4 \
-    -Q pdf_extract_queue &
+    --hostname="io@%h" \
+    --pool=threads \
+    --concurrency="$((4 * $(nproc)))" \
+    -Q pdf_io_queue &
+
+# CPU 队列：PyMuPDF 解析，prefork pool，并发 = CPU 核数
+celery -A celery_app worker \
+    --loglevel=info \
+    --hostname="cpu@%h" \
+    --pool=prefork \
+    --concurrency="$(nproc)" \
+    --max-tasks-per-child=50 \
+    --max-memory-per-child=1048576 \
+    -Q pdf_cpu_queue &
 
 # 等待一下让 Celery Worker 启动
 sleep 3
 
 # 启动 FastAPI（前台运行）
-uvicorn main:app --host 0.0.0.0 --port 8000
+uvicorn main:app --host 0.0.0.0 --port 8000 \
+    --loop uvloop \
+    --http httptools \
+    --workers "${WEB_WORKERS:-4}" \
+    --limit-concurrency 1000 \
+    --timeout-keep-alive 30
@@ -1,4 +1,4 @@
 # PDF Service Tasks Module
-from .extract import extract_pdf_task
+from .extract import download_pdf_task, extract_pdf_pipeline, parse_pdf_task
 
-__all__ = ["extract_pdf_task"]
+__all__ = ["download_pdf_task", "parse_pdf_task", "extract_pdf_pipeline"]
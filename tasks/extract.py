@@ -1,156 +1,309 @@
 """
 Celery 任务: 使用 PyMuPDF 提取 PDF 文本。
 
-工作流程
+工作流程（``extract_pdf_pipeline``，Celery chain）
 --------
-1. 从 R2 / URL 下载 PDF
-2. 校验文件（MIME 类型、大小 <= 100 MB、页数 <= 500）
-3. 使用 PyMuPDF 提取文本
-4. 将提取的文本上传到 R2
-5. 更新 Supabase -> status = completed
+``download_pdf_task``（``pdf_io_queue``，threads pool，高并发）:
+1. 从 R2 / URL 流式下载 PDF 到共享暂存目录 ``PDF_STAGING_DIR``
+
+``parse_pdf_task``（``pdf_cpu_queue``，prefork pool，并发 = CPU 核数）:
+2. 单次打开 PDF：校验（魔数、大小 <= 100 MB、页数 <= 500）并提取文本
+3. 将提取的文本上传到 R2
+4. 更新 Supabase -> status = completed
+
+两个阶段分队列运行，长时间解析不会占用下载并发。
+暂存目录须对两类 Worker 可见（同机部署或共享卷）。
 
 ⚠️ 本模块 import PyMuPDF (fitz)，受 AGPL-3.0 约束。
 
+Supabase 状态只在开始（downloading）与结束（completed / failed）时写入，
+不再写中间进度，减少每个任务的 Supabase 往返次数。
+
 重试策略: 对瞬态错误最多自动重试 2 次。
 校验失败立即拒绝（不重试）。
 """
 
 import logging
 import os
-import shutil
 import tempfile
+import threading
+import time
 from datetime import datetime, timezone
 from pathlib import Path
+from typing import BinaryIO, Iterator, NoReturn
 
 import fitz  # PyMuPDF — AGPL-3.0
-from celery import Task
-from celery.exceptions import Reject, SoftTimeLimitExceeded
+from celery import Task, chain
+from celery.exceptions import Ignore, Reject, Retry, SoftTimeLimitExceeded
+from celery.signals import (
+    celeryd_after_setup,
+    task_revoked,
+    worker_process_init,
+    worker_ready,
+)
+from celery.worker import state as worker_state
 
 from celery_app import celery_app
-from config import PDF_EXTRACT_MAX_FILE_SIZE, PDF_EXTRACT_MAX_PAGES
+from config import (
+    PDF_EXTRACT_MAX_FILE_SIZE,
+    PDF_EXTRACT_MAX_PAGES,
+    PDF_STAGING_DIR,
+    PDF_STAGING_MAX_AGE,
+)
 from exceptions import (
+    DownloadTimeoutError,
     ExtractionError,
     FileValidationError,
     StorageError,
 )
-from services.r2_storage import download_pdf, upload_text
-from services.supabase_client import upsert_extract, mark_failed
+from services.r2_storage import download_pdf_to_file, upload_text_stream
+from services.supabase_client import (
+    configure_pool,
+    mark_failed,
+    reset_client,
+    upsert_extract,
+)
 
 logger = logging.getLogger("pdf_service.tasks.extract")
 
+# 提取结果超过该大小后才落盘，限制单任务常驻内存
+_SPOOL_MAX_SIZE = 8 * 1024 * 1024
+
+# get_text 标志：只保留纯文本所需的处理，跳过图片块与连字保留
+_TEXT_FLAGS = (
+    fitz.TEXTFLAGS_TEXT
+    & ~fitz.TEXT_PRESERVE_IMAGES
+    & ~fitz.TEXT_PRESERVE_LIGATURES
+)
+
+
+# 暂存目录清理的最小间隔（秒）
+_STAGING_SWEEP_INTERVAL = 600
+
+_last_staging_sweep = 0.0
+_staging_sweep_lock = threading.Lock()
+
+
+@celeryd_after_setup.connect
+def _size_supabase_pool(sender=None, instance=None, **kwargs) -> None:
+    """按 Worker 并发数（threads pool 下即线程数）设置 Supabase 连接上限。"""
+    concurrency = getattr(instance, "concurrency", None)
+    if concurrency:
+        configure_pool(concurrency)
+
+
+@worker_process_init.connect
+def _init_worker_process(**kwargs) -> None:
+    """prefork 子进程启动时重建 Supabase 连接池，避免复用父进程的 socket。"""
+    reset_client()
 
-# ── 文件校验 ──────────────────────────────────────────
 
-def _validate_pdf(pdf_bytes: bytes) -> int:
+# ── 暂存目录清理 ──────────────────────────────────────
+# 解析任务的 finally 与 _cleanup_revoked_parse 覆盖正常路径；
+# 硬超时杀死子进程、或暂存后的解析消息从未被消费（非持久化队列）时，
+# 文件只能由这里按修改时间兜底删除。
+
+def _sweep_staging_dir() -> None:
+    """删除 ``PDF_STAGING_DIR`` 中超过 ``PDF_STAGING_MAX_AGE`` 的暂存 PDF。"""
+    cutoff = time.time() - PDF_STAGING_MAX_AGE
+    removed = 0
+    try:
+        entries = list(os.scandir(PDF_STAGING_DIR))
+    except FileNotFoundError:
+        return
+    for entry in entries:
+        try:
+            if (
+                entry.is_file()
+                and entry.name.endswith(".pdf")
+                and entry.stat().st_mtime < cutoff
+            ):
+                os.remove(entry.path)
+                removed += 1
+        except OSError as e:
+            logger.warning(f"Failed to remove stale staged PDF {entry.path}: {e}")
+    if removed:
+        logger.info(f"Removed {removed} stale staged PDF(s) from {PDF_STAGING_DIR}")
+
+
+def _maybe_sweep_staging_dir() -> None:
+    """节流版清理：每个进程至多每 _STAGING_SWEEP_INTERVAL 秒执行一次。"""
+    global _last_staging_sweep
+    if time.monotonic() - _last_staging_sweep < _STAGING_SWEEP_INTERVAL:
+        return
+    if not _staging_sweep_lock.acquire(blocking=False):
+        return
+    try:
+        _last_staging_sweep = time.monotonic()
+        _sweep_staging_dir()
+    finally:
+        _staging_sweep_lock.release()
+
+
+@worker_ready.connect
+def _sweep_staging_on_startup(**kwargs) -> None:
+    """Worker 启动时清理上次运行遗留的暂存文件。"""
+    _maybe_sweep_staging_dir()
+
+
+# ── 校验 + 文本提取 ──────────────────────────────────
+
+def _iter_page_text(doc: fitz.Document) -> Iterator[tuple[int, str]]:
+    """逐页提取文本，产出 ``(页码, 文本)``；跳过空白页。"""
+    for page_num, page in enumerate(doc):
+        # 直接构建 TextPage 并取纯文本，绕过 get_text() 的输出格式分派
+        textpage = page.get_textpage(flags=_TEXT_FLAGS)
+        text = textpage.extractText()
+        del textpage
+        # isspace() 不分配新字符串（strip() 会）
+        if text and not text.isspace():
+            yield page_num, text
+
+
+def _open_validate_extract(
+    pdf_path: Path, paper_id: str, out: BinaryIO
+) -> tuple[int, int]:
     """
-    校验下载的 PDF。
+    校验 PDF 并使用 PyMuPDF 提取文本（单次打开文档）。
+
+    直接打开下载好的本地文件；校验与提取共用同一个 ``fitz.Document``。
+    提取结果逐页以 UTF-8 写入 ``out``，不在内存中拼接整篇文本。
 
-    返回页数。
-    如果无效则抛出 FileValidationError（不可重试）。
+    返回: (文本长度（字符数）, 页数)
+    校验失败抛出 FileValidationError（不可重试），
+    提取失败抛出 ExtractionError（可重试）。
     """
-    size_mb = len(pdf_bytes) / (1024 * 1024)
+    file_size = os.path.getsize(pdf_path)
+    size_mb = file_size / (1024 * 1024)
     max_mb = PDF_EXTRACT_MAX_FILE_SIZE / (1024 * 1024)
-    if len(pdf_bytes) > PDF_EXTRACT_MAX_FILE_SIZE:
+    if file_size > PDF_EXTRACT_MAX_FILE_SIZE:
         raise FileValidationError(
             f"文件过大: {size_mb:.1f}MB (上限 {max_mb:.0f}MB)"
         )
 
-    if not pdf_bytes[:5] == b"%PDF-":
+    with open(pdf_path, "rb") as f:
+        header = f.read(5)
+    if not header == b"%PDF-":
         raise FileValidationError("不是有效的 PDF 文件")
 
-    # 使用临时文件而不是内存流，避免大文件导致 OOM
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp_file:
-        tmp_file.write(pdf_bytes)
-        tmp_file_path = tmp_file.name
-
     try:
-        doc = fitz.open(tmp_file_path)
-        page_count = len(doc)
-        doc.close()
+        doc = fitz.open(pdf_path, filetype="pdf")
     except Exception as e:
-        os.remove(tmp_file_path)
         raise FileValidationError(f"无法读取 PDF: {e}")
 
-    # 删除临时文件
-    os.remove(tmp_file_path)
+    try:
+        page_count = doc.page_count
+        if page_count == 0:
+            raise FileValidationError("PDF 没有页面")
+        if page_count > PDF_EXTRACT_MAX_PAGES:
+            raise FileValidationError(
+                f"页数过多: {page_count} 页 (上限 {PDF_EXTRACT_MAX_PAGES} 页)"
+            )
 
-    if page_count == 0:
-        raise FileValidationError("PDF 没有页面")
-    if page_count > PDF_EXTRACT_MAX_PAGES:
-        raise FileValidationError(
-            f"页数过多: {page_count} 页 (上限 {PDF_EXTRACT_MAX_PAGES} 页)"
+        logger.info(
+            f"[PyMuPDF] Validation OK for paper {paper_id} — "
+            f"{page_count} pages, {size_mb:.1f} MB"
         )
 
-    return page_count
+        try:
+            text_length = 0
+            sep = b""
+            for page_num, text in _iter_page_text(doc):
+                # 分段写入已编码的字节，不再拼接包含整页文本的中间字符串
+                page_header = b"\n--- Page %d ---\n" % (page_num + 1)
+                out.writelines((sep, page_header, text.encode("utf-8"), b"\n"))
+                text_length += len(sep) + len(page_header) + len(text) + 1
+                sep = b"\n"
+        except Exception as e:
+            logger.error(f"[PyMuPDF] Extraction failed for paper {paper_id}: {e}")
+            raise ExtractionError(f"PyMuPDF 提取失败: {e}")
+    finally:
+        doc.close()
+
+    logger.info(
+        f"[PyMuPDF] Extraction completed for paper {paper_id}, "
+        f"{page_count} pages, {text_length} chars"
+    )
+    return text_length, page_count
 
 
-# ── PDF 文本提取 ────────────────────────────────────
+# ── 错误处理 ────────────────────────────────────────
 
-def _extract_text_with_pymupdf(pdf_bytes: bytes, paper_id: str) -> tuple[str, int]:
+def _handle_task_error(task: Task, paper_id: str, exc: Exception) -> NoReturn:
     """
-    使用 PyMuPDF 提取 PDF 文本。
+    下载 / 解析任务共用的错误处理：更新 Supabase 状态后拒绝、重试或重新抛出。
 
-    返回: (提取的文本, 页数)
+    必须在 ``except`` 块内调用。
     """
-    logger.info(f"[PyMuPDF] Starting extraction for paper {paper_id}")
+    attempt = task.request.retries + 1
 
-    # 使用临时文件而不是内存流，避免大文件导致 OOM
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp_file:
-        tmp_file.write(pdf_bytes)
-        tmp_file_path = tmp_file.name
+    if isinstance(exc, FileValidationError):
+        logger.error(f"[{paper_id}] Validation failed: {exc}")
+        mark_failed(paper_id, str(exc))
+        raise Reject(str(exc), requeue=False)
 
-    try:
-        doc = fitz.open(tmp_file_path)
-        full_text = []
+    if isinstance(exc, SoftTimeLimitExceeded):
+        logger.error(f"[{paper_id}] Task timed out (>5 min)")
+        mark_failed(paper_id, "提取超时 (超过 5 分钟)")
+        raise
 
-        for page_num in range(len(doc)):
-            page = doc[page_num]
-            # 提取文本并保留基本格式
-            text = page.get_text("text")
-            if text.strip():
-                full_text.append(f"\n--- Page {page_num + 1} ---\n{text}\n")
+    if isinstance(exc, DownloadTimeoutError):
+        # threads pool 不执行 Celery 时间限制，下载超时由 r2_storage 的总时长检查触发
+        logger.error(f"[{paper_id}] Download timed out: {exc}")
+        mark_failed(paper_id, str(exc))
+        raise
 
-        combined_text = "\n".join(full_text)
+    if isinstance(exc, (ExtractionError, StorageError)):
+        logger.error(
+            f"[{paper_id}] Retryable error (attempt {attempt}): {exc}"
+        )
+        if task.request.retries >= task.max_retries:
+            mark_failed(
+                paper_id,
+                f"提取失败 (已重试 {task.max_retries} 次): {exc}",
+            )
+            raise
+        upsert_extract(paper_id, {
+            "retry_count": task.request.retries + 1,
+            "error_message": f"正在重试 … ({exc})",
+        })
+        raise task.retry(exc=exc)
 
-        # 注意：必须先记录日志再关闭文档，因为关闭后无法获取页数
-        page_count = len(doc)
-        doc.close()
+    logger.error(f"[{paper_id}] Unexpected error: {exc}", exc_info=True)
+    if task.request.retries >= task.max_retries:
+        mark_failed(paper_id, f"未知错误: {exc}")
+        raise
+    raise task.retry(exc=exc)
 
-        logger.info(
-            f"[PyMuPDF] Extraction completed for paper {paper_id}, "
-            f"{page_count} pages, {len(combined_text)} chars"
-        )
-        return combined_text, page_count
 
-    except Exception as e:
-        logger.error(f"[PyMuPDF] Extraction failed for paper {paper_id}: {e}")
-        raise ExtractionError(f"PyMuPDF 提取失败: {e}")
-    finally:
-        # 确保删除临时文件
-        if os.path.exists(tmp_file_path):
-            os.remove(tmp_file_path)
+def _pipeline_revoked(task: Task) -> bool:
+    """流水线中后续任务是否已被取消（取消接口 revoke 的是最后一个任务的 ID）。"""
+    for sig in task.request.chain or ():
+        if sig.get("options", {}).get("task_id") in worker_state.revoked:
+            return True
+    return False
 
 
 # ── Celery 任务 ──────────────────────────────────────
 
 @celery_app.task(
     bind=True,
-    name="tasks.extract_pdf",
+    name="tasks.download_pdf",
     max_retries=2,
     default_retry_delay=30,
-    soft_time_limit=300,
-    time_limit=360,
+    # 不设 soft/hard 时间限制：threads pool 不执行它们；
+    # 实际上限是 r2_storage 中按 PDF_EXTRACT_TASK_TIMEOUT 计算的下载截止时间
     acks_late=True,
     reject_on_worker_lost=True,
 )
-def extract_pdf_task(
+def download_pdf_task(
     self: Task,
     paper_id: str,
     file_url: str,
     mode: str = "text",
 ) -> dict:
     """
-    使用 PyMuPDF 提取 PDF 文本的主流水线。
+    I/O 阶段：下载 PDF 到共享暂存目录（``pdf_io_queue``）。
 
     Parameters
     ----------
@@ -164,19 +317,23 @@ def extract_pdf_task(
     Returns
     -------
     dict
-        提取结果: {paper_id, status, text_length, text_url}
+        暂存信息，作为 ``parse_pdf_task`` 的输入: {paper_id, pdf_path, mode}
     """
     attempt = self.request.retries + 1
     logger.info(
-        f"[{paper_id}] Starting PDF extraction "
+        f"[{paper_id}] Starting PDF download "
         f"(mode={mode}, attempt={attempt}/{self.max_retries + 1})"
     )
 
+    if _pipeline_revoked(self):
+        logger.info(f"[{paper_id}] Extraction cancelled before download, skipping")
+        raise Ignore()
+
     try:
         # ── 步骤 1: 标记下载中 ─────────────────
+        # celery_task_id 由 API 写入（流水线最后一个任务的 ID，用于取消），此处不覆盖
         upsert_extract(paper_id, {
             "status": "downloading",
-            "celery_task_id": self.request.id,
             "extract_mode": mode,
             "retry_count": self.request.retries,
             "started_at": datetime.now(timezone.utc).isoformat(),
@@ -184,42 +341,73 @@ def extract_pdf_task(
         })
 
         logger.info(f"[{paper_id}] Downloading PDF …")
-        pdf_bytes = download_pdf(file_url)
-        logger.info(f"[{paper_id}] Downloaded {len(pdf_bytes)} bytes")
-
-        # ── 步骤 2: 校验 ─────────────────────────
-        page_count = _validate_pdf(pdf_bytes)
+        os.makedirs(PDF_STAGING_DIR, exist_ok=True)
+        _maybe_sweep_staging_dir()
+        pdf_path = download_pdf_to_file(file_url, dir=PDF_STAGING_DIR)
         logger.info(
-            f"[{paper_id}] Validation OK — "
-            f"{page_count} pages, {len(pdf_bytes) / 1024 / 1024:.1f} MB"
+            f"[{paper_id}] Downloaded {os.path.getsize(pdf_path)} bytes → {pdf_path}"
         )
 
-        # ── 步骤 3: 提取文本 ─────────────────────
-        upsert_extract(paper_id, {
-            "status": "extracting",
-            "progress_percent": 50,
-            "page_count": page_count,
-        })
+        return {"paper_id": paper_id, "pdf_path": str(pdf_path), "mode": mode}
 
-        logger.info(f"[{paper_id}] Starting PyMuPDF extraction …")
-        extracted_text, page_count = _extract_text_with_pymupdf(pdf_bytes, paper_id)
-        text_length = len(extracted_text)
+    except Exception as e:
+        _handle_task_error(self, paper_id, e)
 
-        logger.info(
-            f"[{paper_id}] Extracted {text_length} chars from {page_count} pages"
-        )
 
-        # ── 步骤 4: 上传到 R2 ─────────────────────
-        upsert_extract(paper_id, {
-            "status": "uploading",
-            "progress_percent": 80,
-        })
+@celery_app.task(
+    bind=True,
+    name="tasks.parse_pdf",
+    max_retries=2,
+    default_retry_delay=30,
+    soft_time_limit=300,
+    time_limit=360,
+    acks_late=True,
+    reject_on_worker_lost=True,
+)
+def parse_pdf_task(self: Task, staged: dict) -> dict:
+    """
+    CPU 阶段：校验、提取文本并上传到 R2（``pdf_cpu_queue``）。
+
+    Parameters
+    ----------
+    staged : dict
+        ``download_pdf_task`` 的返回值: {paper_id, pdf_path, mode}
+
+    Returns
+    -------
+    dict
+        提取结果: {paper_id, status, text_length, text_url}
+    """
+    paper_id = staged["paper_id"]
+    pdf_path = Path(staged["pdf_path"])
+    attempt = self.request.retries + 1
+    logger.info(
+        f"[{paper_id}] Starting PDF extraction "
+        f"(mode={staged['mode']}, attempt={attempt}/{self.max_retries + 1})"
+    )
 
-        r2_key = f"papers/{paper_id}/extracted_text.txt"
-        text_url = upload_text(extracted_text, r2_key)
-        logger.info(f"[{paper_id}] Uploaded text to R2: {r2_key}")
+    # 重试时保留暂存文件，其余情况（成功 / 最终失败）都删除
+    keep_staged = False
+    try:
+        # ── 步骤 2: 校验 + 提取文本 ─────────────
+        # 提取文本逐页写入 spool（超过 _SPOOL_MAX_SIZE 自动落盘），再流式上传
+        with tempfile.SpooledTemporaryFile(max_size=_SPOOL_MAX_SIZE) as spool:
+            logger.info(f"[{paper_id}] Starting PyMuPDF validation + extraction …")
+            text_length, page_count = _open_validate_extract(
+                pdf_path, paper_id, spool
+            )
+
+            logger.info(
+                f"[{paper_id}] Extracted {text_length} chars from {page_count} pages"
+            )
 
-        # ── 步骤 5: 完成 ─────────────────────────
+            # ── 步骤 3: 上传到 R2 ─────────────────────
+            r2_key = f"papers/{paper_id}/extracted_text.txt"
+            spool.seek(0)
+            text_url = upload_text_stream(spool, r2_key)
+            logger.info(f"[{paper_id}] Uploaded text to R2: {r2_key}")
+
+        # ── 步骤 4: 完成 ─────────────────────────
         upsert_extract(paper_id, {
             "status": "completed",
             "progress_percent": 100,
@@ -242,37 +430,36 @@ def extract_pdf_task(
             "text_url": text_url,
         }
 
-    # ── 错误处理 ────────────────────────────────────
+    except Exception as e:
+        try:
+            _handle_task_error(self, paper_id, e)
+        except Retry:
+            keep_staged = True
+            raise
 
-    except FileValidationError as e:
-        logger.error(f"[{paper_id}] Validation failed: {e}")
-        mark_failed(paper_id, str(e))
-        raise Reject(str(e), requeue=False)
+    finally:
+        if not keep_staged:
+            pdf_path.unlink(missing_ok=True)
 
-    except SoftTimeLimitExceeded:
-        logger.error(f"[{paper_id}] Task timed out (>5 min)")
-        mark_failed(paper_id, "提取超时 (超过 5 分钟)")
-        raise
 
-    except (ExtractionError, StorageError) as e:
-        logger.error(
-            f"[{paper_id}] Retryable error (attempt {attempt}): {e}"
-        )
-        if self.request.retries >= self.max_retries:
-            mark_failed(
-                paper_id,
-                f"提取失败 (已重试 {self.max_retries} 次): {e}",
-            )
-            raise
-        upsert_extract(paper_id, {
-            "retry_count": self.request.retries + 1,
-            "error_message": f"正在重试 … ({e})",
-        })
-        raise self.retry(exc=e)
+@task_revoked.connect
+def _cleanup_revoked_parse(sender=None, request=None, **kwargs) -> None:
+    """被取消的解析任务不会执行 ``finally``，在此删除其暂存的 PDF。"""
+    if getattr(sender, "name", None) != parse_pdf_task.name:
+        return
+    args = getattr(request, "args", None) or ()
+    if args and isinstance(args[0], dict) and args[0].get("pdf_path"):
+        Path(args[0]["pdf_path"]).unlink(missing_ok=True)
 
-    except Exception as e:
-        logger.error(f"[{paper_id}] Unexpected error: {e}", exc_info=True)
-        if self.request.retries >= self.max_retries:
-            mark_failed(paper_id, f"未知错误: {e}")
-            raise
-        raise self.retry(exc=e)
+
+def extract_pdf_pipeline(paper_id: str, file_url: str, mode: str = "text"):
+    """
+    构建完整提取流水线: 下载（I/O 队列）→ 解析 + 上传（CPU 队列）。
+
+    ``apply_async(task_id=...)`` 指定的是最后一个任务（``parse_pdf_task``）的 ID，
+    对其 revoke 即可取消尚未开始或正在运行的解析。
+    """
+    return chain(
+        download_pdf_task.s(paper_id=paper_id, file_url=file_url, mode=mode),
+        parse_pdf_task.s(),
+    )